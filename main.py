@@ -1,9 +1,17 @@
+import asyncio
+import hashlib
 import os
+import re
+from array import array
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
 from typing import Optional, List
-from fastapi import FastAPI, HTTPException, Header, Depends
+from fastapi import FastAPI, HTTPException, Header, Depends, Query, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
-from supabase import create_client, Client
+from cachetools import LRUCache, TTLCache
+from supabase import acreate_client, AsyncClient
 from google import genai
 from google.genai import types
 
@@ -13,14 +21,74 @@ SUPABASE_URL = os.environ.get("SUPABASE_URL")
 SUPABASE_SERVICE_KEY = os.environ.get("SUPABASE_SERVICE_ROLE_KEY") 
 GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
 
+CHAT_MODEL = "gemini-1.5-pro"
+CHAT_TEMPERATURE = 0.5
+EMBED_MODEL = "text-embedding-004"
+
+SYSTEM_PROMPT = """You are Shikhbo AI, a friendly tutor for Bangladeshi students.
+
+Subject: {subject}
+
+{context_block}Instructions:
+{source_rules}- Explain simply in a mix of Bangla and English (Banglish) or pure English as preferred.
+- Use LaTeX for math ($...$).
+"""
+
+# Only included when RAG found textbook context
+CONTEXT_BLOCK = """Context from textbook:
+{context}
+
+"""
+
+CONTEXT_RULES = """- Answer based on the context provided.
+- If the answer isn't in the context, use your general knowledge but mention it.
+"""
+
+NO_CONTEXT_RULES = """- No textbook context was found for this question; answer from your general knowledge of the subject and mention that.
+"""
+
+# Appended to /chat/stream output when Gemini fails after streaming has started
+STREAM_ERROR_MARKER = "\n\n[Gemini Error: response interrupted]"
+
+# Whitespace normalisation for uploaded textbook text. Tabs (table columns)
+# and line-leading indentation (poems) are kept; only padding is removed.
+_TRAILING_SPACE = re.compile(r"[ \t\u00a0]+$", re.MULTILINE)
+_INLINE_SPACE = re.compile(r"(?<=\S)[ \u00a0]{2,}")
+_EXTRA_NEWLINES = re.compile(r"\n{3,}")
+
 if not SUPABASE_URL or not SUPABASE_SERVICE_KEY:
     raise RuntimeError("Supabase credentials missing")
 
 # Initialize Clients
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
+# Supabase: async client created once per worker on startup (see lifespan)
+supabase: AsyncClient = None
+# Gemini: shared module-level client; handlers use the async `client.aio` API
+# so calls don't block the event loop and pooled connections are reused
 client = genai.Client(api_key=GEMINI_API_KEY)
+# Caps in-flight batch embed calls per worker, shared across concurrent uploads
+EMBED_SEMAPHORE = asyncio.Semaphore(8)
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global supabase
+    supabase = await acreate_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
+    yield
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+
+# --- Caches ---
+# Queries are keyed by a 16-byte digest so long messages don't bloat memory.
+# Textbook context per (query, class_level, subject). Admin upload evicts the
+# affected entries on its own worker; the short TTL bounds staleness on the
+# others. Empty results aren't cached, so new content is found right away.
+RAG_CACHE = TTLCache(maxsize=1024, ttl=300)
+# Query embeddings per query, stored as float64 arrays (~6 KB each instead of
+# ~25 KB as a list, with exact values); independent of textbook content, so no TTL
+EMBED_CACHE = LRUCache(maxsize=512)
+# Profile role per user id for verify_admin; roles rarely change
+ROLE_CACHE = TTLCache(maxsize=1024, ttl=60)
+# Gemini replies per full prompt; short TTL only dedupes repeat taps/reloads
+REPLY_CACHE = TTLCache(maxsize=1024, ttl=60)
 
 app.add_middleware(
     CORSMiddleware,
@@ -52,31 +120,44 @@ async def verify_token(authorization: str = Header(...)):
     if not authorization.startswith("Bearer "):
         raise HTTPException(401, "Invalid header")
     token = authorization.split(" ")[1]
-    user = supabase.auth.get_user(token)
+    user = await supabase.auth.get_user(token)
     if not user:
         raise HTTPException(401, "Invalid token")
     return user.user
 
 async def verify_admin(user=Depends(verify_token)):
-    # Check profile role
-    res = supabase.table("profiles").select("role").eq("id", user.id).single().execute()
-    if not res.data or res.data.get("role") != 'admin':
+    # Check profile role (cached briefly to skip a DB read per admin request)
+    role = ROLE_CACHE.get(user.id)
+    if role is None:
+        res = await supabase.table("profiles").select("role").eq("id", user.id).single().execute()
+        role = res.data.get("role") if res.data else None
+        ROLE_CACHE[user.id] = role
+    if role != 'admin':
         raise HTTPException(403, "Admins only")
     return user
 
 # --- Logic ---
-def get_rag_context(query: str, class_level: str, subject: str) -> str:
+async def get_rag_context(query: str, class_level: str, subject: str) -> str:
+    query_key = hashlib.blake2b(query.encode(), digest_size=16).digest()
+    key = (query_key, class_level, subject)
+    cached = RAG_CACHE.get(key)
+    if cached is not None:
+        return cached
+
     try:
         # 1. Embed Query
-        embed_res = client.models.embed_content(
-            model="text-embedding-004",
-            contents=query
-        )
-        vector = embed_res.embeddings[0].values
+        vector = EMBED_CACHE.get(query_key)
+        if vector is None:
+            embed_res = await client.aio.models.embed_content(
+                model=EMBED_MODEL,
+                contents=query
+            )
+            vector = array("d", embed_res.embeddings[0].values)
+            EMBED_CACHE[query_key] = vector
 
         # 2. Search DB (RPC Call)
-        rpc_res = supabase.rpc("match_textbook_content", {
-            "query_embedding": vector,
+        rpc_res = await supabase.rpc("match_textbook_content", {
+            "query_embedding": vector.tolist(),
             "match_threshold": 0.5,
             "match_count": 3,
             "filter_class": class_level,
@@ -84,92 +165,193 @@ def get_rag_context(query: str, class_level: str, subject: str) -> str:
         }).execute()
 
         chunks = [item['chunk_text'] for item in rpc_res.data]
-        return "\n\n".join(chunks)
+        context = "\n\n".join(chunks)
+        if context:
+            RAG_CACHE[key] = context
+        return context
     except Exception as e:
         print(f"RAG Error: {e}")
         return ""
 
+def build_system_instruction(subject: str, context: str) -> str:
+    # Skip the context block entirely when RAG found nothing
+    if context:
+        context_block = CONTEXT_BLOCK.format(context=context)
+        source_rules = CONTEXT_RULES
+    else:
+        context_block = ""
+        source_rules = NO_CONTEXT_RULES
+    return SYSTEM_PROMPT.format(subject=subject, context_block=context_block, source_rules=source_rules)
+
+def chat_config(system_instruction: str) -> types.GenerateContentConfig:
+    return types.GenerateContentConfig(
+        system_instruction=system_instruction,
+        temperature=CHAT_TEMPERATURE
+    )
+
+def utc_now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+async def upsert_session(user_id: str, req: ChatRequest, asked_at: str):
+    await supabase.table("sessions").upsert({
+        "id": req.session_id,
+        "user_id": user_id,
+        "subject": req.subject,
+        "chapter_id": req.chapter_id,
+        "last_active": asked_at
+    }).execute()
+
+async def save_messages(req: ChatRequest, reply: str, asked_at: str, answered_at: str):
+    # Runs after the reply is sent, so failures can only be logged.
+    # Explicit timestamps keep user -> ai order; a shared now() would tie.
+    try:
+        await supabase.table("messages").insert([
+            {"session_id": req.session_id, "role": "user", "content": req.message, "created_at": asked_at},
+            {"session_id": req.session_id, "role": "ai", "content": reply, "created_at": answered_at}
+        ]).execute()
+    except Exception as e:
+        print(f"History Error: {e}")
+
 # --- Routes ---
 
 @app.post("/chat")
-async def chat_endpoint(req: ChatRequest, user=Depends(verify_token)):
-    # 1. RAG
-    context = get_rag_context(req.message, req.class_level, req.subject)
+async def chat_endpoint(req: ChatRequest, background: BackgroundTasks, user=Depends(verify_token)):
+    asked_at = utc_now()
+
+    # 1. RAG (session upsert runs concurrently; it doesn't depend on the reply)
+    context, _ = await asyncio.gather(
+        get_rag_context(req.message, req.class_level, req.subject),
+        upsert_session(user.id, req, asked_at)
+    )
     
     # 2. System Prompt
-    system_instruction = f"""
-    You are Shikhbo AI, a friendly tutor for Bangladeshi students.
-    
-    Context from textbook ({req.subject}):
-    {context}
-    
-    Instructions:
-    - Answer based on the context provided.
-    - If the answer isn't in the context, use your general knowledge but mention it.
-    - Explain simply in a mix of Bangla and English (Banglish) or pure English as preferred.
-    - Use LaTeX for math ($...$).
-    """
-
-    # 3. Generate
+    system_instruction = build_system_instruction(req.subject, context)
+
+    # 3. Generate (identical prompts within the TTL reuse the last reply)
+    reply_key = hashlib.sha256(f"{system_instruction}\0{req.message}".encode()).digest()
+    reply = REPLY_CACHE.get(reply_key)
+    if reply is None:
+        try:
+            resp = await client.aio.models.generate_content(
+                model=CHAT_MODEL,
+                contents=req.message,
+                config=chat_config(system_instruction)
+            )
+            reply = resp.text
+        except Exception as e:
+            raise HTTPException(500, f"Gemini Error: {e}")
+        REPLY_CACHE[reply_key] = reply
+
+    # 4. Save History (after the response is sent)
+    background.add_task(save_messages, req, reply, asked_at, utc_now())
+
+    return {"reply": reply}
+
+@app.post("/chat/stream")
+async def chat_stream_endpoint(req: ChatRequest, background: BackgroundTasks, user=Depends(verify_token)):
+    # Same as /chat, but tokens are sent as Gemini produces them
+    asked_at = utc_now()
+    context, _ = await asyncio.gather(
+        get_rag_context(req.message, req.class_level, req.subject),
+        upsert_session(user.id, req, asked_at)
+    )
+    system_instruction = build_system_instruction(req.subject, context)
+
+    # Open the stream and wait for the first chunk before responding, so
+    # Gemini failures surface as a 500 like /chat instead of an empty 200
     try:
-        resp = client.models.generate_content(
-            model="gemini-1.5-pro",
+        stream = await client.aio.models.generate_content_stream(
+            model=CHAT_MODEL,
             contents=req.message,
-            config=types.GenerateContentConfig(
-                system_instruction=system_instruction,
-                temperature=0.5
-            )
+            config=chat_config(system_instruction)
         )
-        reply = resp.text
+        first = await anext(stream, None)
     except Exception as e:
         raise HTTPException(500, f"Gemini Error: {e}")
 
-    # 4. Save History (Async in production)
-    # Upsert Session
-    supabase.table("sessions").upsert({
-        "id": req.session_id,
-        "user_id": user.id,
-        "subject": req.subject,
-        "chapter_id": req.chapter_id,
-        "last_active": "now()"
-    }).execute()
+    async def generate():
+        parts = []
+        if first is not None and first.text:
+            parts.append(first.text)
+            yield first.text
+        try:
+            async for chunk in stream:
+                if chunk.text:
+                    parts.append(chunk.text)
+                    yield chunk.text
+        except Exception as e:
+            # Status is already sent; tell the client the reply is incomplete
+            print(f"Gemini Stream Error: {e}")
+            yield STREAM_ERROR_MARKER
+            return
 
-    # Insert Messages
-    supabase.table("messages").insert([
-        {"session_id": req.session_id, "role": "user", "content": req.message},
-        {"session_id": req.session_id, "role": "ai", "content": reply}
-    ]).execute()
+        # Persist the complete reply after the stream closes
+        if parts:
+            background.add_task(save_messages, req, "".join(parts), asked_at, utc_now())
 
-    return {"reply": reply}
+    return StreamingResponse(generate(), media_type="text/plain; charset=utf-8")
 
 @app.get("/history")
-async def get_history(session_id: str, user=Depends(verify_token)):
-    res = supabase.table("messages").select("*").eq("session_id", session_id).order("created_at").execute()
-    return {"messages": res.data}
+async def get_history(
+    session_id: str,
+    limit: int = Query(500, ge=1, le=500),
+    before: Optional[datetime] = None,
+    user=Depends(verify_token)
+):
+    # Fetch the newest page (bounded) and return it oldest -> newest.
+    # The default page covers typical sessions in full; pass the returned
+    # next_cursor as `before` to load older messages.
+    query = supabase.table("messages").select("id, role, content, created_at").eq("session_id", session_id)
+    if before:
+        query = query.lt("created_at", before.isoformat())
+    res = await query.order("created_at", desc=True).limit(limit).execute()
+
+    messages = res.data[::-1]
+    next_cursor = messages[0]["created_at"] if len(messages) == limit else None
+    return {"messages": messages, "next_cursor": next_cursor}
 
 @app.post("/admin/upload")
 async def admin_upload(req: UploadRequest, user=Depends(verify_admin)):
-    # Simple chunker (every 800 chars)
+    # Simple chunker (every 800 chars), after collapsing runs of whitespace so
+    # chunks (and the prompts built from them) don't carry padding
     chunk_size = 800
-    text = req.text
+    text = req.text.replace("\r\n", "\n").replace("\r", "\n")
+    text = _TRAILING_SPACE.sub("", text)
+    text = _INLINE_SPACE.sub(" ", text)
+    text = _EXTRA_NEWLINES.sub("\n\n", text).strip("\n")
+    if not text:
+        raise HTTPException(400, "Text is empty")
     chunks = [text[i:i+chunk_size] for i in range(0, len(text), chunk_size)]
     
-    count = 0
-    for chunk in chunks:
-        # Embed
-        emb = client.models.embed_content(
-            model="text-embedding-004",
-            contents=chunk
-        ).embeddings[0].values
-        
-        # Save
-        supabase.table("textbook_content").insert({
+    # Embed up to 100 chunks per call (API batch limit) instead of one call per chunk,
+    # running batches concurrently under the worker-wide cap
+    embed_batch_size = 100
+
+    async def embed_batch(batch: List[str]) -> List[dict]:
+        async with EMBED_SEMAPHORE:
+            res = await client.aio.models.embed_content(
+                model=EMBED_MODEL,
+                contents=batch
+            )
+        return [{
             "class_level": req.class_level,
             "subject": req.subject,
             "chapter_id": req.chapter_id,
             "chunk_text": chunk,
-            "embedding": emb
-        }).execute()
-        count += 1
-        
-    return {"status": "success", "chunks": count}
+            "embedding": emb.values
+        } for chunk, emb in zip(batch, res.embeddings, strict=True)]
+
+    batches = [chunks[i:i+embed_batch_size] for i in range(0, len(chunks), embed_batch_size)]
+    results = await asyncio.gather(*(embed_batch(b) for b in batches))
+    rows = [row for batch_rows in results for row in batch_rows]
+
+    # Save chunks with bulk inserts, capped per request to keep payloads bounded
+    insert_batch_size = 500
+    for i in range(0, len(rows), insert_batch_size):
+        await supabase.table("textbook_content").insert(rows[i:i+insert_batch_size]).execute()
+
+    # Evict cached context for this class/subject so new content is used
+    for key in [k for k in RAG_CACHE if k[1] == req.class_level and k[2] == req.subject]:
+        RAG_CACHE.pop(key, None)
+
+    return {"status": "success", "chunks": len(rows)}